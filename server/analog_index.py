@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Historical Analog Search for NARR Environments
+Embeds each 3-hourly NARR time as a PCA projection of sector-clipped
+CAPE/SRH/shear fields and answers "which past dates looked like this?"
+with nearest-neighbour queries over a compact on-disk index.
+
+Index layout (one directory per sector):
+    analog_index/s15/basis.npz    PCA basis shared by every year
+    analog_index/s15/1999.npz     embeddings + valid times for one year
+"""
+
+import xarray as xr
+import numpy as np
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+
+from narr_fetcher import get_narr_url, SECTOR_BOUNDS
+
+# Output directory for analog index shards
+ANALOG_DIR = Path(__file__).parent / "analog_index"
+
+# NARR fields that make up the environment embedding
+ANALOG_VARIABLES = ['cape', 'hlcy', 'vwsh']
+
+# Number of principal components kept per time
+N_COMPONENTS = 16
+
+# Keep every Nth grid point (NARR is ~32 km, analogs only need the synoptic pattern)
+GRID_STRIDE = 2
+
+# Sample every Nth time when fitting the basis (7 x 3h cycles through all hours of day)
+BASIS_SAMPLE_STRIDE = 7
+
+# Number of years (from the start of the build list) used to fit the basis
+BASIS_FIT_YEARS = 3
+
+# Times fetched per OPeNDAP request when building a year (~1 month)
+CHUNK_TIMES = 248
+
+# Analogs closer than this to the query (or to each other) count as the same event
+DEFAULT_EXCLUDE_HOURS = 72
+
+
+def sector_dir(sector: int, index_dir: Path = ANALOG_DIR) -> Path:
+    """Directory holding the index for one sector."""
+    return Path(index_dir) / f"s{sector}"
+
+
+def _sector_slices(lat: np.ndarray, lon: np.ndarray, sector: int):
+    """
+    Get y/x slices of the NARR grid covering a sector's lat/lon bounds.
+    NARR is on a Lambert Conformal grid, so clip to the bounding box of the mask.
+    """
+    bounds = SECTOR_BOUNDS[sector]
+    mask = ((lat >= bounds['minLat']) & (lat <= bounds['maxLat']) &
+            (lon >= bounds['minLon']) & (lon <= bounds['maxLon']))
+    rows = np.where(mask.any(axis=1))[0]
+    cols = np.where(mask.any(axis=0))[0]
+
+    return (slice(rows[0], rows[-1] + 1, GRID_STRIDE),
+            slice(cols[0], cols[-1] + 1, GRID_STRIDE))
+
+
+def _open_sector(year: int, sector: int):
+    """
+    Lazily open the analog variables for a year, clipped to a sector.
+    Returns (datasets, data arrays, valid times). Caller closes the datasets.
+    """
+    datasets = []
+    arrays = []
+    times = None
+
+    for variable in ANALOG_VARIABLES:
+        url = get_narr_url(variable, year, 1)
+        print(f"Opening: {url}")
+        ds = xr.open_dataset(url)
+        datasets.append(ds)
+
+        ys, xs = _sector_slices(ds['lat'].values, ds['lon'].values, sector)
+        arrays.append(ds[variable].isel(y=ys, x=xs))
+
+        if times is None:
+            times = ds['time'].values.astype('datetime64[h]')
+
+    return datasets, arrays, times
+
+
+def _load_fields(arrays, time_sel) -> np.ndarray:
+    """Load a time selection from each variable into a (time, variable, point) array."""
+    blocks = []
+    for da in arrays:
+        values = da.isel(time=time_sel).values
+        blocks.append(values.reshape(values.shape[0], -1))
+
+    return np.stack(blocks, axis=1).astype(np.float32)
+
+
+def _standardize(fields: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """Scale each variable to unit variance and flatten to (time, feature)."""
+    x = fields / scale[None, :, None]
+    return x.reshape(x.shape[0], -1)
+
+
+def _project(fields: np.ndarray, basis) -> np.ndarray:
+    """Project (time, variable, point) fields onto the PCA basis."""
+    x = _standardize(fields, basis['scale']) - basis['mean']
+    # NARR masks points outside its domain - treat missing as the mean state
+    x = np.nan_to_num(x, nan=0.0)
+    return (x @ basis['components'].T).astype(np.float32)
+
+
+def _atomic_savez(path: Path, **arrays):
+    """Write an .npz next to its final path, then rename it into place."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_basis(sector: int, index_dir: Path = ANALOG_DIR) -> dict:
+    """Load the PCA basis for a sector."""
+    with np.load(sector_dir(sector, index_dir) / "basis.npz") as f:
+        return {k: f[k] for k in f.files}
+
+
+def fit_basis(sector: int, years, n_components: int = N_COMPONENTS,
+              index_dir: Path = ANALOG_DIR) -> dict:
+    """
+    Fit the PCA basis for a sector from a subsample of times in the given years.
+    Every year shard is projected onto this basis, so it is fitted once and reused.
+    """
+    samples = []
+    for year in years:
+        datasets, arrays, times = _open_sector(year, sector)
+        try:
+            samples.append(_load_fields(arrays, slice(None, None, BASIS_SAMPLE_STRIDE)))
+        finally:
+            for ds in datasets:
+                ds.close()
+
+    fields = np.concatenate(samples)
+    print(f"Fitting basis for sector {sector} on {fields.shape[0]} times")
+
+    # Per-variable scale so CAPE (J/kg) doesn't swamp shear (1/s)
+    scale = np.nanstd(fields, axis=(0, 2)).astype(np.float32)
+    scale[scale == 0] = 1.0
+
+    x = _standardize(fields, scale)
+    mean = np.nan_to_num(np.nanmean(x, axis=0), nan=0.0).astype(np.float32)
+    x = np.nan_to_num(x - mean, nan=0.0)
+
+    _, s, vt = np.linalg.svd(x, full_matrices=False)
+    components = vt[:n_components].astype(np.float32)
+    explained = (s[:n_components] ** 2) / np.sum(s ** 2)
+
+    basis_id = hashlib.sha1(components.tobytes()).hexdigest()[:12]
+    basis = {
+        'scale': scale,
+        'mean': mean,
+        'components': components,
+        'explained': explained.astype(np.float32),
+        'basis_id': np.array(basis_id),
+    }
+    _atomic_savez(sector_dir(sector, index_dir) / "basis.npz", **basis)
+    print(f"Basis {basis_id}: {explained.sum():.1%} of variance in {n_components} components")
+
+    return basis
+
+
+def _year_end(year: int) -> np.datetime64:
+    """Last 3-hourly NARR time of a year."""
+    return np.datetime64(datetime(year, 12, 31, 21), 'h')
+
+
+def build_year(sector: int, year: int, index_dir: Path = ANALOG_DIR,
+               force: bool = False) -> int:
+    """
+    Embed every 3-hourly time in a year and write the year's shard.
+    An existing shard is only re-embedded if the remote file has gained times,
+    unless force is set.
+    Returns the number of times in the shard.
+    """
+    basis = load_basis(sector, index_dir)
+    path = sector_dir(sector, index_dir) / f"{year}.npz"
+    datasets, arrays, times = _open_sector(year, sector)
+
+    try:
+        if path.exists() and not force:
+            with np.load(path) as f:
+                unchanged = (str(f['basis_id']) == str(basis['basis_id']) and
+                             len(f['times']) == len(times))
+            if unchanged:
+                print(f"No new times for {year} sector {sector} ({len(times)} times)")
+                return len(times)
+
+        chunks = []
+        for start in range(0, len(times), CHUNK_TIMES):
+            fields = _load_fields(arrays, slice(start, start + CHUNK_TIMES))
+            chunks.append(_project(fields, basis))
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    _atomic_savez(path,
+                  embeddings=np.concatenate(chunks),
+                  times=times,
+                  basis_id=basis['basis_id'])
+    print(f"Indexed {year} sector {sector}: {len(times)} times")
+
+    return len(times)
+
+
+def _shard_is_current(path: Path, basis_id: str) -> bool:
+    """
+    Check a year shard exists, was built against the current basis and covers
+    the whole year. Partial years (still updating upstream) are never current.
+    """
+    if not path.exists():
+        return False
+    with np.load(path) as f:
+        return (str(f['basis_id']) == basis_id and len(f['times']) > 0 and
+                f['times'][-1] >= _year_end(int(path.stem)))
+
+
+def build_index(sector: int, years, workers: int = 4, rebuild: bool = False,
+                index_dir: Path = ANALOG_DIR):
+    """
+    Build (or extend) the analog index for a sector.
+
+    Years that already have a complete shard for the current basis are skipped,
+    so re-running with a longer year range only fetches the new years, and a
+    year indexed while still incomplete picks up its new times. Remaining
+    years are built in parallel, one process per year.
+
+    A rebuild refits the basis and re-embeds every requested year plus every
+    year already on disk, since shards from the old basis are no longer usable.
+
+    Args:
+        sector: SPC sector number
+        years: Iterable of years to index
+        workers: Number of parallel year builds
+        rebuild: Refit the basis and rebuild every year
+        index_dir: Root directory for the index
+    """
+    years = sorted(set(years))
+    basis_path = sector_dir(sector, index_dir) / "basis.npz"
+
+    if rebuild or not basis_path.exists():
+        basis = fit_basis(sector, years[:BASIS_FIT_YEARS], index_dir=index_dir)
+    else:
+        basis = load_basis(sector, index_dir)
+    basis_id = str(basis['basis_id'])
+
+    if rebuild:
+        existing = [int(p.stem) for p in sector_dir(sector, index_dir).glob("[0-9]*.npz")]
+        years = sorted(set(years) | set(existing))
+        pending = list(years)
+    else:
+        pending = [y for y in years
+                   if not _shard_is_current(sector_dir(sector, index_dir) / f"{y}.npz", basis_id)]
+    print(f"Sector {sector}: {len(years) - len(pending)} years current, {len(pending)} to build")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(build_year, sector, y, index_dir, rebuild): y for y in pending}
+        for future in as_completed(futures):
+            year = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error indexing {year}: {e}")
+                failed.append(year)
+
+    return failed
+
+
+class IndexNotBuiltError(Exception):
+    """Raised when a sector has no usable analog index on disk."""
+
+
+class AnalogIndex:
+    """
+    In-memory nearest-neighbour index over every year shard of one sector.
+    """
+
+    def __init__(self, sector: int, index_dir: Path = ANALOG_DIR):
+        self.sector = sector
+        self.path = sector_dir(sector, index_dir)
+        self.signature = _index_signature(self.path)
+
+        if not (self.path / "basis.npz").exists():
+            raise IndexNotBuiltError(f"No analog index built for sector {sector}")
+
+        self.basis = load_basis(sector, index_dir)
+        basis_id = str(self.basis['basis_id'])
+
+        embeddings = []
+        times = []
+        for shard in sorted(self.path.glob("[0-9]*.npz")):
+            with np.load(shard) as f:
+                # Skip shards left over from a previous basis
+                if str(f['basis_id']) != basis_id:
+                    continue
+                embeddings.append(f['embeddings'])
+                times.append(f['times'])
+
+        if not embeddings:
+            raise IndexNotBuiltError(f"No analog index built for sector {sector}")
+
+        self.embeddings = np.concatenate(embeddings)
+        self.times = np.concatenate(times)
+        order = np.argsort(self.times)
+        self.embeddings = self.embeddings[order]
+        self.times = self.times[order]
+        self.tree = cKDTree(self.embeddings)
+
+    def __len__(self):
+        return len(self.times)
+
+    def embed(self, year: int, month: int, day: int, hour: int) -> np.ndarray:
+        """
+        Get the embedding for a time, fetching and projecting it if it isn't indexed.
+        """
+        target = np.datetime64(datetime(year, month, day, (hour // 3) * 3), 'h')
+        i = np.searchsorted(self.times, target)
+        if i < len(self.times) and self.times[i] == target:
+            return self.embeddings[i]
+
+        datasets, arrays, times = _open_sector(year, self.sector)
+        try:
+            time_idx = int(np.searchsorted(times, target))
+            if time_idx >= len(times) or times[time_idx] != target:
+                raise ValueError(f"No NARR data for {target}")
+            fields = _load_fields(arrays, [time_idx])
+        finally:
+            for ds in datasets:
+                ds.close()
+
+        return _project(fields, self.basis)[0]
+
+    def query(self, year: int, month: int, day: int, hour: int, count: int = 10,
+              exclude_hours: int = DEFAULT_EXCLUDE_HOURS):
+        """
+        Find the past times whose environment most resembles the given time.
+
+        Args:
+            year, month, day, hour: Query time (hour rounded down to 3h)
+            count: Number of analogs to return
+            exclude_hours: Minimum separation from the query and between analogs,
+                so neighbouring times of one event aren't returned as separate analogs
+
+        Returns:
+            List of (datetime, distance) tuples, closest first
+        """
+        target = np.datetime64(datetime(year, month, day, (hour // 3) * 3), 'h')
+        window = np.timedelta64(exclude_hours, 'h')
+        vector = self.embed(year, month, day, hour)
+
+        # Over-fetch neighbours, then thin out ones from the same event
+        k = min(len(self), count * 32)
+        while True:
+            distances, indices = self.tree.query(vector, k=k)
+            distances = np.atleast_1d(distances)
+            indices = np.atleast_1d(indices)
+
+            accepted = []
+            for dist, idx in zip(distances, indices):
+                t = self.times[idx]
+                if abs(t - target) < window:
+                    continue
+                if any(abs(t - a) < window for a, _ in accepted):
+                    continue
+                accepted.append((t, float(dist)))
+                if len(accepted) == count:
+                    break
+
+            if len(accepted) == count or k == len(self):
+                break
+            k = min(len(self), k * 4)
+
+        return [(t.astype(datetime), dist) for t, dist in accepted]
+
+
+def _index_signature(path: Path):
+    """Cheap fingerprint of a sector's shard files, used to detect rebuilds."""
+    if not path.exists():
+        return ()
+    return tuple(sorted((e.name, e.stat().st_mtime_ns)
+                        for e in os.scandir(path) if e.name.endswith('.npz')))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(sector: int) -> AnalogIndex:
+    """
+    Get the loaded index for a sector, reloading it if shards changed on disk.
+    """
+    with _indexes_lock:
+        index = _indexes.get(sector)
+        if index is None or index.signature != _index_signature(index.path):
+            index = AnalogIndex(sector)
+            _indexes[sector] = index
+        return index
+
+
+def find_analogs(year: int, month: int, day: int, hour: int, sector: int = 15,
+                 count: int = 10, exclude_hours: int = DEFAULT_EXCLUDE_HOURS):
+    """
+    Main function to rank historical analogs for a date.
+
+    Returns:
+        List of (datetime, distance) tuples, closest first
+    """
+    return get_index(sector).query(year, month, day, hour, count, exclude_hours)
+
+
+def parse_years(spec: str):
+    """Parse a year list like '1979-2019' or '1999,2011,2013'."""
+    years = []
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            years.extend(range(int(start), int(end) + 1))
+        else:
+            years.append(int(part))
+    return years
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the NARR analog index")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help='Build or extend the index for a sector')
+    build.add_argument('--sector', type=int, default=15)
+    build.add_argument('--years', default=f"1979-{datetime.now().year - 1}")
+    build.add_argument('--workers', type=int, default=4)
+    build.add_argument('--rebuild', action='store_true', help='Refit basis and rebuild all years')
+
+    query = sub.add_parser('query', help='Rank analogs for a YYYYMMDDHH date')
+    query.add_argument('date')
+    query.add_argument('--sector', type=int, default=15)
+    query.add_argument('--count', type=int, default=10)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        failed = build_index(args.sector, parse_years(args.years), args.workers, args.rebuild)
+        if failed:
+            print(f"Failed years (re-run to retry): {sorted(failed)}")
+    else:
+        d = args.date
+        analogs = find_analogs(int(d[0:4]), int(d[4:6]), int(d[6:8]), int(d[8:10]),
+                               args.sector, args.count)
+        for rank, (t, dist) in enumerate(analogs, 1):
+            print(f"{rank:2d}. {t:%Y-%m-%d %HZ}  distance {dist:.2f}")
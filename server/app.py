@@ -6,6 +6,7 @@ Flask server for serving historic NARR mesoanalysis images
 from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from narr_fetcher import generate_mesoanalysis, PARAM_MAP, SECTOR_BOUNDS
+from analog_index import find_analogs, IndexNotBuiltError
 import traceback
 
 app = Flask(__name__)
@@ -25,6 +26,7 @@ def index():
             '/mesoanalysis/<param>/<date>': 'Get mesoanalysis image',
             '/params': 'List available parameters',
             '/sectors': 'List available sectors',
+            '/analogs/<date>': 'Rank historical dates with the most similar environment',
         },
         'example': '/mesoanalysis/sbcp/2011052221?sector=14',
         'date_format': 'YYYYMMDDHH (hour in UTC, rounded to 3h)',
@@ -121,6 +123,68 @@ def get_mesoanalysis(param: str, date: str):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/analogs/<date>')
+def get_analogs(date: str):
+    """
+    Rank past NARR times whose CAPE/SRH/shear environment most resembles a date.
+
+    Args:
+        date: Date in YYYYMMDDHH format
+
+    Query params:
+        sector: Sector number (default 15)
+        count: Number of analogs to return (default 10, max 50)
+    """
+    try:
+        if len(date) != 10 or not date.isdigit():
+            return jsonify({'error': 'Date must be YYYYMMDDHH format'}), 400
+
+        year = int(date[0:4])
+        month = int(date[4:6])
+        day = int(date[6:8])
+        hour = int(date[8:10])
+
+        # Validate
+        if year < 1979 or year > 2025:
+            return jsonify({'error': 'Year must be 1979-2025'}), 400
+        if month < 1 or month > 12:
+            return jsonify({'error': 'Month must be 1-12'}), 400
+        if day < 1 or day > 31:
+            return jsonify({'error': 'Day must be 1-31'}), 400
+        if hour < 0 or hour > 23:
+            return jsonify({'error': 'Hour must be 0-23'}), 400
+
+        sector = request.args.get('sector', 15, type=int)
+        if sector not in SECTOR_BOUNDS:
+            return jsonify({'error': f'Invalid sector. Valid: {list(SECTOR_BOUNDS.keys())}'}), 400
+
+        count = request.args.get('count', 10, type=int)
+        if count < 1 or count > 50:
+            return jsonify({'error': 'Count must be 1-50'}), 400
+
+        analogs = find_analogs(year, month, day, hour, sector, count)
+
+        return jsonify({
+            'date': date,
+            'sector': sector,
+            'analogs': [
+                {'rank': rank, 'date': t.strftime('%Y%m%d%H'), 'distance': round(dist, 3)}
+                for rank, (t, dist) in enumerate(analogs, 1)
+            ],
+        })
+
+    except IndexNotBuiltError as e:
+        return jsonify({
+            'error': str(e),
+            'hint': f'Run: python analog_index.py build --sector {sector}'
+        }), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
@@ -134,6 +198,7 @@ if __name__ == '__main__':
     print("  GET /mesoanalysis/<param>/<date>?sector=<n>")
     print("  GET /params")
     print("  GET /sectors")
+    print("  GET /analogs/<date>?sector=<n>&count=<n>")
     print("")
     print("Example: http://localhost:5000/mesoanalysis/sbcp/2011052221?sector=14")
     print("")
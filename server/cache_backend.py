@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Render Cache Backends for the NARR Server
+Lets several server replicas share rendered images instead of each one
+fetching and rendering the same products.
+
+Backends:
+    local       per-process directory (default, the original behaviour)
+    shared      shared filesystem directory with atomic publishes
+    memcached   memcached-protocol servers, keys placed by consistent hashing
+
+Every backend sits behind an in-memory LRU read-through tier.
+
+Configured from the environment:
+    NARR_CACHE_BACKEND    local | shared | memcached (default local)
+    NARR_CACHE_DIR        directory for local/shared backends
+    NARR_CACHE_SERVERS    host:port[,host:port...] for memcached
+    NARR_CACHE_MEMORY_MB  size of the in-memory tier (default 64, 0 disables)
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+import argparse
+import bisect
+import hashlib
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+
+class CacheBackend:
+    """Interface for render cache storage. Misses return None."""
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+
+class LocalDiskCache(CacheBackend):
+    """
+    One file per key in a local directory.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path / key
+        if path.exists():
+            return path.read_bytes()
+        return None
+
+    def put(self, key: str, data: bytes):
+        (self.path / key).write_bytes(data)
+
+
+class SharedDirCache(CacheBackend):
+    """
+    Directory on a filesystem shared by every replica (NFS, EFS, etc.).
+
+    Writes go to a temp file in the destination directory and are renamed into
+    place, so readers on other nodes see either nothing or the whole image.
+    No locks are taken: if two replicas render the same key, the last rename wins
+    and both files are identical anyway.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _key_path(self, key: str) -> Path:
+        # Fan out into subdirectories to keep directory listings small on NFS
+        prefix = hashlib.md5(key.encode()).hexdigest()[:2]
+        return self.path / prefix / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._key_path(key).read_bytes()
+        except FileNotFoundError:
+            pass
+        # Fall back to the flat layout so an existing local cache dir stays usable
+        try:
+            return (self.path / key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        path = self._key_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{key}.", suffix='.tmp')
+        try:
+            # mkstemp creates 0600 files; replicas may run as other users
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes.
+    Adding or removing a node only moves the keys that node owned.
+    """
+
+    def __init__(self, nodes, vnodes: int = 160):
+        self.ring = []
+        for node in nodes:
+            for i in range(vnodes):
+                self.ring.append((self._hash(f"{node}#{i}"), node))
+        self.ring.sort()
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def node_for(self, key: str):
+        """Get the node owning a key (first point clockwise from the key's hash)."""
+        i = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.ring[i][1]
+
+
+class MemcachedCache(CacheBackend):
+    """
+    Key-value network cache speaking the memcached text protocol.
+
+    Keys are spread over the servers with a consistent hash ring. Network errors
+    are logged and treated as misses so a cache outage never fails a render.
+    A server that fails is skipped for `retry_after` seconds instead of making
+    every request wait out the connect timeout.
+    """
+
+    def __init__(self, servers, timeout: float = 2.0, expire: int = 0,
+                 retry_after: float = 30.0):
+        self.servers = {s.strip(): self._parse_server(s) for s in servers if s.strip()}
+        if not self.servers:
+            raise ValueError("No memcached servers configured (NARR_CACHE_SERVERS)")
+        self.ring = HashRing(self.servers)
+        self.timeout = timeout
+        self.expire = expire
+        self.retry_after = retry_after
+        self.pools = {server: queue.LifoQueue() for server in self.servers.values()}
+        self.dead_until = {}
+
+    @staticmethod
+    def _parse_server(server: str):
+        host, _, port = server.strip().rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid memcached server {server!r} (expected host:port)")
+        return (host, int(port))
+
+    def _is_dead(self, server) -> bool:
+        return time.monotonic() < self.dead_until.get(server, 0)
+
+    def _mark_dead(self, server):
+        self.dead_until[server] = time.monotonic() + self.retry_after
+        # Pooled connections to a failed server are unlikely to be usable
+        while True:
+            try:
+                self._discard(self.pools[server].get_nowait())
+            except queue.Empty:
+                break
+
+    def _connect(self, server):
+        """Open a fresh (socket, reader) pair to a server."""
+        sock = socket.create_connection(server, timeout=self.timeout)
+        return sock, sock.makefile('rb')
+
+    def _release(self, server, conn):
+        self.pools[server].put(conn)
+
+    @staticmethod
+    def _discard(conn):
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    @staticmethod
+    def _read_line(f) -> bytes:
+        line = f.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by cache server')
+        return line[:-2]
+
+    def _request(self, server, op):
+        """
+        Run op(sock, reader) on a pooled connection, falling back to a fresh one.
+
+        Idle pooled connections may have been closed by the peer (server restart,
+        idle timeout, firewall reset), so a failure on one is retried once on a
+        new connection. Only a failure on a fresh connection propagates.
+        """
+        try:
+            conn = self.pools[server].get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is not None:
+            try:
+                result = op(*conn)
+                self._release(server, conn)
+                return result
+            except OSError:
+                self._discard(conn)
+            except BaseException:
+                self._discard(conn)
+                raise
+
+        conn = self._connect(server)
+        try:
+            result = op(*conn)
+        except BaseException:
+            self._discard(conn)
+            raise
+        self._release(server, conn)
+        return result
+
+    def _get(self, key: str, sock, f) -> Optional[bytes]:
+        sock.sendall(f"get {key}\r\n".encode())
+
+        data = None
+        header = self._read_line(f)
+        if header.startswith(b'VALUE '):
+            size = int(header.split()[3])
+            data = f.read(size + 2)[:-2]
+            header = self._read_line(f)
+        if header != b'END':
+            raise ValueError(f'Unexpected cache response: {header!r}')
+
+        return data
+
+    def _set(self, key: str, data: bytes, sock, f) -> bytes:
+        sock.sendall(f"set {key} 0 {self.expire} {len(data)}\r\n".encode() + data + b'\r\n')
+        return self._read_line(f)
+
+    def get(self, key: str) -> Optional[bytes]:
+        server = self.servers[self.ring.node_for(key)]
+        if self._is_dead(server):
+            return None
+        try:
+            return self._request(server, lambda sock, f: self._get(key, sock, f))
+        except OSError as e:
+            print(f"Cache get failed on {server[0]}:{server[1]}: {e}")
+            self._mark_dead(server)
+        except (ValueError, IndexError) as e:
+            print(f"Cache get failed on {server[0]}:{server[1]}: {e}")
+        return None
+
+    def put(self, key: str, data: bytes):
+        server = self.servers[self.ring.node_for(key)]
+        if self._is_dead(server):
+            return
+        try:
+            reply = self._request(server, lambda sock, f: self._set(key, data, sock, f))
+            if reply != b'STORED':
+                print(f"Cache set rejected on {server[0]}:{server[1]}: {reply!r}")
+        except OSError as e:
+            print(f"Cache set failed on {server[0]}:{server[1]}: {e}")
+            self._mark_dead(server)
+        except ValueError as e:
+            print(f"Cache set failed on {server[0]}:{server[1]}: {e}")
+
+
+class MemoryCache(CacheBackend):
+    """
+    In-process LRU read-through tier in front of another backend.
+    Hits from the backend are kept in memory; puts write through to both.
+    """
+
+    def __init__(self, backend: CacheBackend, max_bytes: int = 64 * 1024 * 1024):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+                return data
+
+        data = self.backend.get(key)
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        self.backend.put(key, data)
+        self._remember(key, data)
+
+
+def create_cache(default_dir: Path) -> CacheBackend:
+    """
+    Build the render cache from NARR_CACHE_* environment variables.
+    """
+    kind = os.environ.get('NARR_CACHE_BACKEND', 'local')
+    cache_dir = Path(os.environ.get('NARR_CACHE_DIR', default_dir))
+
+    if kind == 'local':
+        backend = LocalDiskCache(cache_dir)
+    elif kind == 'shared':
+        backend = SharedDirCache(cache_dir)
+    elif kind == 'memcached':
+        servers = os.environ.get('NARR_CACHE_SERVERS', '127.0.0.1:11211').split(',')
+        backend = MemcachedCache(servers)
+    else:
+        raise ValueError(f"Unknown NARR_CACHE_BACKEND: {kind} (use local, shared or memcached)")
+
+    memory_mb = int(os.environ.get('NARR_CACHE_MEMORY_MB', 64))
+    if memory_mb > 0:
+        return MemoryCache(backend, memory_mb * 1024 * 1024)
+    return backend
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    """Handles the get/set subset of the memcached protocol."""
+
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        super().finish()
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+
+            if parts[0] == b'get':
+                for key in parts[1:]:
+                    data = store.get(key)
+                    if data is not None:
+                        self.wfile.write(b'VALUE %s 0 %d\r\n%s\r\n' % (key, len(data), data))
+                self.wfile.write(b'END\r\n')
+            elif parts[0] == b'set' and len(parts) >= 5:
+                data = self.rfile.read(int(parts[4]) + 2)[:-2]
+                store[parts[1]] = data
+                if parts[-1] != b'noreply':
+                    self.wfile.write(b'STORED\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """
+    Minimal in-memory memcached stand-in for local development and testing
+    of the memcached backend without a real memcached install.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 11211)):
+        super().__init__(address, _StandInHandler)
+        self.store = {}
+        self.connections = set()
+
+    def drop_connections(self):
+        """Close every client connection, as a memcached restart would."""
+        for conn in list(self.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local memcached stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    args = parser.parse_args()
+
+    print(f"Memcached stand-in listening on {args.host}:{args.port}")
+    StandInServer((args.host, args.port)).serve_forever()
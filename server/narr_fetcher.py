@@ -18,6 +18,8 @@ from pathlib import Path
 import io
 import os
 
+from cache_backend import create_cache
+
 # NARR OPeNDAP base URL
 NARR_BASE = "https://psl.noaa.gov/thredds/dodsC/Datasets/NARR"
 
@@ -25,6 +27,9 @@ NARR_BASE = "https://psl.noaa.gov/thredds/dodsC/Datasets/NARR"
 CACHE_DIR = Path(__file__).parent / "cache"
 CACHE_DIR.mkdir(exist_ok=True)
 
+# Render cache (local disk by default, see cache_backend for shared backends)
+CACHE = create_cache(CACHE_DIR)
+
 # SPC-style colormaps
 COLORMAPS = {
     'cape': {
@@ -319,10 +324,10 @@ def get_time_index(year: int, month: int, day: int, hour: int) -> int:
     return time_index
 
 
-def fetch_narr_data(variable: str, year: int, month: int, day: int, hour: int):
+def get_narr_url(variable: str, year: int, month: int) -> str:
     """
-    Fetch NARR data for a specific variable and time via OPeNDAP.
-    Returns xarray DataArray with lat/lon coordinates.
+    Build the OPeNDAP URL for a NARR variable.
+    Monolevel variables live in yearly files, pressure level variables in monthly files.
     """
     # Monolevel variables with special naming patterns (based on PSL THREDDS catalog)
     monolevel_2m = ['dpt', 'air', 'rhum', 'shum']  # These have .2m suffix
@@ -336,27 +341,28 @@ def fetch_narr_data(variable: str, year: int, month: int, day: int, hour: int):
                        'soilm', 'mstav', 'lhtfl', 'shtfl', 'gflux']
 
     if variable in monolevel_tropo:
-        url = f"{NARR_BASE}/monolevel/{variable}.tropo.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.tropo.{year}.nc"
     elif variable in monolevel_hl1:
-        url = f"{NARR_BASE}/monolevel/{variable}.hl1.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.hl1.{year}.nc"
     elif variable in monolevel_2m:
-        url = f"{NARR_BASE}/monolevel/{variable}.2m.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.2m.{year}.nc"
     elif variable in monolevel_10m:
-        url = f"{NARR_BASE}/monolevel/{variable}.10m.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.10m.{year}.nc"
     elif variable in monolevel_sfc:
-        url = f"{NARR_BASE}/monolevel/{variable}.sfc.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.sfc.{year}.nc"
     elif variable in monolevel_plain:
-        url = f"{NARR_BASE}/monolevel/{variable}.{year}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/monolevel/{variable}.{year}.nc"
     else:
         # Try pressure level (monthly files)
-        url = f"{NARR_BASE}/pressure/{variable}.{year}{month:02d}.nc"
-        var_name = variable
+        return f"{NARR_BASE}/pressure/{variable}.{year}{month:02d}.nc"
+
+
+def fetch_narr_data(variable: str, year: int, month: int, day: int, hour: int):
+    """
+    Fetch NARR data for a specific variable and time via OPeNDAP.
+    Returns xarray DataArray with lat/lon coordinates.
+    """
+    url = get_narr_url(variable, year, month)
 
     print(f"Fetching: {url}")
 
@@ -485,11 +491,11 @@ def generate_mesoanalysis(param: str, year: int, month: int, day: int,
 
     # Check cache first
     cache_key = f"{param}_{year}{month:02d}{day:02d}{hour:02d}_s{sector}.png"
-    cache_path = CACHE_DIR / cache_key
 
-    if cache_path.exists():
+    cached = CACHE.get(cache_key)
+    if cached is not None:
         print(f"Cache hit: {cache_key}")
-        return cache_path.read_bytes()
+        return cached
 
     # Fetch data
     if narr_var == 'shear':
@@ -531,7 +537,7 @@ def generate_mesoanalysis(param: str, year: int, month: int, day: int,
     img_bytes = render_image(data, lat, lon, narr_var, sector, title)
 
     # Cache it
-    cache_path.write_bytes(img_bytes)
+    CACHE.put(cache_key, img_bytes)
     print(f"Cached: {cache_key}")
 
     return img_bytes
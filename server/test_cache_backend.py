@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Tests for the render cache backends, run against the in-process memcached stand-in.
+
+    python -m unittest test_cache_backend
+"""
+
+import os
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+from cache_backend import HashRing, MemcachedCache, MemoryCache, SharedDirCache, StandInServer
+
+
+def start_stand_in():
+    """Start a stand-in on a free port and return (server, 'host:port')."""
+    server = StandInServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    host, port = server.server_address
+    return server, f"{host}:{port}"
+
+
+def unused_address():
+    """Get a local host:port with nothing listening on it."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    host, port = sock.getsockname()
+    sock.close()
+    return f"{host}:{port}"
+
+
+class MemcachedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [start_stand_in() for _ in range(3)]
+        self.addresses = [address for _, address in self.servers]
+        self.cache = MemcachedCache(self.addresses, timeout=0.5)
+
+    def tearDown(self):
+        for server, _ in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_round_trip(self):
+        # Payload containing protocol markers must come back byte for byte
+        data = os.urandom(200000) + b'\r\nEND\r\nVALUE x 0 1\r\n'
+        self.cache.put('sbcp_2011052221_s14.png', data)
+        self.assertEqual(self.cache.get('sbcp_2011052221_s14.png'), data)
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('missing.png'))
+
+    def test_keys_placed_by_ring(self):
+        keys = [f"k{i}.png" for i in range(60)]
+        for key in keys:
+            self.cache.put(key, key.encode())
+
+        ring = HashRing(self.addresses)
+        for (server, address) in self.servers:
+            expected = {k.encode() for k in keys if ring.node_for(k) == address}
+            self.assertEqual(set(server.store), expected)
+        self.assertTrue(all(server.store for server, _ in self.servers))
+
+    def test_reconnect_after_dropped_connection(self):
+        self.cache.put('a.png', b'a')
+        for server, _ in self.servers:
+            server.drop_connections()
+
+        # Stale pooled connections are retried on a fresh one, not marked dead
+        self.cache.put('b.png', b'b')
+        self.assertEqual(self.cache.get('a.png'), b'a')
+        self.assertEqual(self.cache.get('b.png'), b'b')
+        self.assertEqual(self.cache.dead_until, {})
+
+    def test_dead_server_backoff(self):
+        dead = unused_address()
+        cache = MemcachedCache([dead], timeout=0.5, retry_after=60)
+        cache.put('a.png', b'a')
+        self.assertIn(cache.servers[dead], cache.dead_until)
+
+        # While backing off, requests miss without trying to connect
+        cache._connect = lambda server: self.fail('connected to a dead server')
+        self.assertIsNone(cache.get('a.png'))
+        cache.put('a.png', b'a')
+
+    def test_blank_server_entries(self):
+        cache = MemcachedCache([self.addresses[0], '', ' '])
+        self.assertEqual(list(cache.servers), [self.addresses[0]])
+        with self.assertRaises(ValueError):
+            MemcachedCache(['cache1'])
+        with self.assertRaises(ValueError):
+            MemcachedCache([''])
+
+    def test_memory_tier_read_through(self):
+        cache = MemoryCache(self.cache, max_bytes=10)
+        self.cache.put('a.png', b'12345')
+        self.assertEqual(cache.get('a.png'), b'12345')
+        cache.put('b.png', b'678901')
+        # Over budget: oldest entry evicted, backend still has it
+        self.assertNotIn('a.png', cache.items)
+        self.assertEqual(cache.get('a.png'), b'12345')
+
+
+class SharedDirCacheTest(unittest.TestCase):
+
+    def test_publish_is_world_readable(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = SharedDirCache(d)
+            cache.put('a.png', b'a')
+            path = cache._key_path('a.png')
+            self.assertEqual(cache.get('a.png'), b'a')
+            self.assertTrue(os.stat(path).st_mode & stat.S_IROTH)
+            self.assertEqual(os.listdir(path.parent), ['a.png'])
+
+    def test_reads_flat_layout(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'old.png'), 'wb') as f:
+                f.write(b'old')
+            self.assertEqual(SharedDirCache(d).get('old.png'), b'old')
+            self.assertIsNone(SharedDirCache(d).get('new.png'))
+
+
+if __name__ == '__main__':
+    unittest.main()